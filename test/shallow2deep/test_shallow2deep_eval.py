@@ -0,0 +1,205 @@
+import os
+import sys
+import unittest
+from importlib.util import find_spec
+from shutil import rmtree
+from unittest import mock
+
+import h5py
+import numpy as np
+
+# vigra and bioimageio are imported by torch_em.shallow2deep, but they are not needed to evaluate the enhancers,
+# because the enhancers and ilastik projects are replaced by simple functions in the tests below.
+# so we stub them if they are not installed
+OPTIONAL_MODULES = {
+    "vigra": ["vigra", "vigra.filters"],
+    "bioimageio": [
+        "bioimageio", "bioimageio.core", "bioimageio.core.build_spec", "bioimageio.core.prediction_pipeline",
+        "bioimageio.core.prediction_pipeline._model_adapters",
+        "bioimageio.core.prediction_pipeline._model_adapters._pytorch_model_adapter",
+        "bioimageio.core.weight_converter", "bioimageio.core.weight_converter.torch",
+        "bioimageio.spec", "bioimageio.spec.shared",
+    ],
+}
+
+
+def _import_shallow2deep_eval():
+    stubs = {
+        name: mock.MagicMock()
+        for module, names in OPTIONAL_MODULES.items() if find_spec(module) is None for name in names
+    }
+    sys.modules.update(stubs)
+    try:
+        import torch_em.shallow2deep.shallow2deep_eval as shallow2deep_eval
+    finally:
+        # remove the stubs and the modules that were imported with them again, so that they don't affect other tests
+        if stubs:
+            for name in list(sys.modules):
+                if name in stubs or name.startswith("torch_em.shallow2deep") or name == "torch_em.util.modelzoo":
+                    del sys.modules[name]
+    return shallow2deep_eval
+
+
+# the enhancers scale the random forest predictions and the ilastik projects add an offset to the data,
+# the scale and offset are read from the "model" files
+class Enhancer:
+    def __init__(self, scale):
+        self.scale = scale
+
+    def __call__(self, x):
+        return [np.asarray(x) * self.scale]
+
+
+class IlastikProject:
+    def __init__(self, offset):
+        self.offset = offset
+
+    def __call__(self, x):
+        return np.clip(x + self.offset, 0, 1).astype("float32")
+
+
+def load_enhancer(path):
+    with open(path) as f:
+        return Enhancer(float(f.read()))
+
+
+def load_ilastik_predicter(path, ndim, output_channel):
+    with open(path) as f:
+        return IlastikProject(float(f.read()))
+
+
+def metric(pred, y):
+    return float(np.abs(np.asarray(pred).squeeze() - y).mean())
+
+
+class TestShallow2DeepEval(unittest.TestCase):
+    tmp_folder = "./tmp"
+    scales = {"enh-a": 1.0, "enh-b": 0.5}
+    offsets = {"ilp-a": 0.1, "ilp-b": 0.2}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.shallow2deep_eval = _import_shallow2deep_eval()
+
+    def setUp(self):
+        os.makedirs(self.tmp_folder, exist_ok=True)
+        self.enhancers = {name: self._write_model(name, scale) for name, scale in self.scales.items()}
+        self.ilastik_projects = {name: self._write_model(name, offset) for name, offset in self.offsets.items()}
+        self.data = np.random.rand(4, 32, 32).astype("float32")
+        self.labels = (self.data > 0.5).astype("float32")
+
+        patches = [
+            mock.patch.object(self.shallow2deep_eval, "_load_enhancer", load_enhancer),
+            mock.patch.object(self.shallow2deep_eval, "_load_ilastik_predicter", load_ilastik_predicter),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.shallow2deep_eval.clear_model_cache()
+        try:
+            rmtree(self.tmp_folder)
+        except OSError:
+            pass
+
+    def _write_model(self, name, value):
+        path = os.path.join(self.tmp_folder, name)
+        with open(path, "w") as f:
+            f.write(str(value))
+        return path
+
+    def _evaluate(self, **kwargs):
+        return self.shallow2deep_eval.evaluate_enhancers(
+            self.data, self.labels, self.enhancers, self.ilastik_projects, metric, **kwargs
+        )
+
+    def _expected_scores(self):
+        # all slices have the same size, so the mean over the slice scores is the same as the score of the volume
+        expected = []
+        for scale in list(self.scales.values()) + [1.0]:
+            expected.append([
+                metric(np.clip(self.data + offset, 0, 1) * scale, self.labels) for offset in self.offsets.values()
+            ])
+        return np.array(expected)
+
+    def _check_scores(self, scores, is2d, atol=1e-5):
+        if not is2d:
+            scores = scores.set_index("enhancer")
+        self.assertEqual(list(scores.index), list(self.scales.keys()) + ["rf-score"])
+        self.assertEqual(list(scores.columns), list(self.offsets.keys()))
+        self.assertTrue(np.allclose(scores.values, self._expected_scores(), atol=atol))
+
+    def test_evaluate_enhancers(self):
+        for is2d in (False, True):
+            self._check_scores(self._evaluate(is2d=is2d), is2d)
+        self._check_scores(self._evaluate(is2d=True, n_threads=2), is2d=True)
+
+    def test_evaluate_enhancers_cached(self):
+        for ext in (".h5", ".zarr"):
+            for is2d in (False, True):
+                save_path = os.path.join(self.tmp_folder, f"cache-{is2d}{ext}")
+                for cache_dtype, atol in [("float16", 1e-3), ("uint8", 5e-3)]:
+                    if os.path.exists(save_path):
+                        rmtree(save_path) if os.path.isdir(save_path) else os.remove(save_path)
+                    scores = self._evaluate(is2d=is2d, save_path=save_path, n_threads=2, cache_dtype=cache_dtype)
+                    self._check_scores(scores, is2d, atol=atol)
+                    # the second run loads all predictions from the cache and must give the same result
+                    cached_scores = self._evaluate(
+                        is2d=is2d, save_path=save_path, n_threads=2, cache_dtype=cache_dtype
+                    )
+                    self.assertTrue(np.array_equal(scores.values, cached_scores.values))
+
+    def test_load_predictions(self):
+        expected_names = list(self.offsets.keys()) + [
+            f"{enh_name}/{ilp_name}" for enh_name in self.scales for ilp_name in self.offsets
+        ]
+        for is2d in (False, True):
+            save_path = os.path.join(self.tmp_folder, f"cache-{is2d}.h5")
+            self._evaluate(is2d=is2d, save_path=save_path)
+            with h5py.File(save_path, "r") as f:
+                self.assertEqual(f["ilp-a"].dtype if not is2d else f["ilp-a/0000"].dtype, np.dtype("float16"))
+
+            predictions = self.shallow2deep_eval.load_predictions(save_path, n_threads=2)
+            self.assertEqual(sorted(predictions.keys()), sorted(expected_names))
+            # the slices are stacked along a new first axis, followed by the batch and channel axis
+            expected_shape = (4, 1, 1, 32, 32) if is2d else (1, 1, 4, 32, 32)
+            for name, pred in predictions.items():
+                self.assertEqual(pred.shape, expected_shape)
+                self.assertEqual(pred.dtype, np.dtype("float32"))
+            rf_pred = np.clip(self.data + self.offsets["ilp-b"], 0, 1)
+            self.assertTrue(np.allclose(predictions["ilp-b"].squeeze(), rf_pred, atol=1e-3))
+
+    def test_compression(self):
+        get_compression_kwargs = self.shallow2deep_eval._get_compression_kwargs
+        self.assertEqual(get_compression_kwargs(None, "cache.h5"), {"compression": "lzf"})
+        self.assertEqual(get_compression_kwargs(None, "cache.zarr"), {"compression": "gzip"})
+        with self.assertRaises(ValueError):
+            get_compression_kwargs("lzf", "cache.zarr")
+
+    def test_write_error(self):
+        # errors in the writer thread are raised after the evaluation
+        save_path = os.path.join(self.tmp_folder, "cache.h5")
+        with self.assertRaises(ValueError):
+            self._evaluate(is2d=True, save_path=save_path, n_threads=2, compression="not-a-compression")
+
+    def test_cache_models(self):
+        scores = self._evaluate(cache_models=True)
+        self.assertEqual(len(self.shallow2deep_eval._model_cache), 4)
+        self.assertTrue(np.array_equal(self._evaluate(cache_models=True).values, scores.values))
+
+        # changing a model on disk loads it again
+        self._write_model("enh-a", 0.25)
+        os.utime(self.enhancers["enh-a"], (0, 0))
+        self.scales = {"enh-a": 0.25, "enh-b": 0.5}
+        self._check_scores(self._evaluate(cache_models=True), is2d=False)
+        self.assertEqual(len(self.shallow2deep_eval._model_cache), 4)
+
+        self.shallow2deep_eval.clear_model_cache()
+        self.assertEqual(len(self.shallow2deep_eval._model_cache), 0)
+        self._evaluate()
+        self.assertEqual(len(self.shallow2deep_eval._model_cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
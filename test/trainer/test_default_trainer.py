@@ -97,6 +97,24 @@ class TestDefaultTrainer(unittest.TestCase):
         trainer2.fit(10)
         self.assertEqual(trainer2.iteration, 20)
 
+    def test_from_checkpoint_safetensors(self):
+        from torch_em.trainer import DefaultTrainer
+        from torch_em.trainer.default_trainer import safetensors_torch
+        if safetensors_torch is None:
+            self.skipTest("safetensors is not installed")
+
+        trainer = DefaultTrainer(**self._get_kwargs(), use_safetensors=True)
+        trainer.fit(10)
+        exp_model = trainer.model
+
+        save_folder = os.path.join(self.checkpoint_folder, self.name)
+        self.assertTrue(os.path.exists(os.path.join(save_folder, "latest.safetensors")))
+
+        trainer2 = DefaultTrainer.from_checkpoint(save_folder, name="latest")
+        self.assertTrue(trainer2.use_safetensors)
+        self.assertEqual(trainer.iteration, trainer2.iteration)
+        self.assertTrue(torch_em.util.model_is_equal(exp_model, trainer2.model))
+
 
 if __name__ == "__main__":
     unittest.main()
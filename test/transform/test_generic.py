@@ -29,8 +29,37 @@ class TestTile(TestCase):
         actual = tile_aug(x)
 
         assert actual.shape == expected.shape
+        numpy.testing.assert_allclose(actual.numpy(), expected)
 
         a = numpy.array(data)
 
         actual = tile_aug(a)
         assert actual.shape == expected.shape
+
+
+class TestCompose(TestCase):
+    def test_compose(self):
+        from torch_em.transform import Compose, Rescale
+
+        data = numpy.random.rand(32, 32)
+        trafo = Compose(Rescale(scale=0.5), Tile((2, 2)))
+        self.assertEqual(len(trafo), 2)
+        self.assertEqual(trafo(data).shape, (32, 32))
+
+        labels = numpy.random.rand(32, 32)
+        trafo = Compose(Rescale(scale=0.5), Rescale(scale=2))
+        outputs = trafo(data, labels)
+        self.assertIsInstance(outputs, tuple)
+        self.assertEqual([out.shape for out in outputs], [(32, 32), (32, 32)])
+
+
+class TestRescale(TestCase):
+    def test_rescale_with_channels(self):
+        from skimage.transform import rescale
+        from torch_em.transform import Rescale
+
+        data = numpy.random.rand(3, 32, 32)
+        actual = Rescale(scale=0.5, with_channels=True)(data)
+        expected = numpy.concatenate([rescale(chan, scale=0.5, preserve_range=True)[None] for chan in data])
+        self.assertEqual(actual.shape, (3, 16, 16))
+        numpy.testing.assert_allclose(actual, expected)
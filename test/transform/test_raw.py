@@ -0,0 +1,283 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+
+class TestRaw(unittest.TestCase):
+    def test_standardize(self):
+        from torch_em.transform.raw import standardize
+
+        x = (np.random.rand(8, 64, 64) * 1000 + 500).astype("float32")
+        for axis in (None, (1, 2)):
+            xt = standardize(x, axis=axis)
+            self.assertEqual(xt.dtype, np.dtype("float32"))
+            expected = (x - x.mean(axis=axis, keepdims=True)) / (x.std(axis=axis, keepdims=True) + 1e-7)
+            self.assertTrue(np.allclose(xt, expected, atol=1e-4))
+
+        # with a given mean the data is not centered, so the std must be computed as usual
+        xt = standardize(x, mean=100.0)
+        expected = (x - 100.0) / ((x - 100.0).std() + 1e-7)
+        self.assertTrue(np.allclose(xt, expected, atol=1e-4))
+
+    def test_standardize_large(self):
+        import torch
+        from torch_em.transform.raw import standardize
+
+        # the std must also be accurate for large volumes, where naive float32 accumulation loses precision
+        x = (np.random.rand(16, 1024, 1024) * 10 + 1000).astype("float32")
+        for inp in (x, torch.from_numpy(x)):
+            xt = np.asarray(standardize(inp))
+            self.assertLess(abs(xt.std(dtype="float64") - 1.0), 5e-6)
+
+    def test_cast(self):
+        import torch
+        from torch_em.transform.raw import cast, cast_float32
+
+        x = np.random.rand(8, 8).astype("float32")
+        for inp in (x, torch.from_numpy(x)):
+            # no copy is made if the dtype already matches
+            self.assertIs(cast(inp, "float32"), inp)
+            self.assertIs(cast_float32(inp), inp)
+            out = cast(inp, "float16")
+            self.assertEqual(str(out.dtype).split(".")[-1], "float16")
+            self.assertTrue(np.allclose(np.asarray(out, dtype="float32"), x, atol=1e-3))
+
+    def test_normalize_integer(self):
+        from torch_em.transform.raw import normalize
+
+        for dtype in ("uint8", "uint16", "int32"):
+            x = np.random.randint(0, 255, size=(4, 64, 64)).astype(dtype)
+            for axis in (None, (1, 2)):
+                xt = normalize(x, axis=axis)
+                self.assertEqual(xt.dtype, np.dtype("float32"))
+                self.assertTrue(np.array_equal(xt, normalize(x.astype("float32"), axis=axis)))
+
+    def test_normalize_strided(self):
+        from torch_em.transform.raw import normalize, standardize
+
+        # channel last data that is transposed to channel first
+        x = np.random.rand(64, 64, 3).transpose((2, 0, 1))
+        for function in (normalize, standardize):
+            xt = function(x, axis=(1, 2))
+            self.assertTrue(xt.flags.c_contiguous)
+            self.assertTrue(np.allclose(xt, function(np.ascontiguousarray(x), axis=(1, 2))))
+
+    def test_normalize_and_standardize_torch(self):
+        import torch
+        from torch_em.transform.raw import normalize, standardize
+
+        x = np.random.rand(4, 64, 64).astype("float32") * 100
+        for function in (normalize, standardize):
+            for axis in (None, (1, 2)):
+                xt = torch.from_numpy(x.copy())
+                out = function(xt, axis=axis)
+                self.assertIsInstance(out, torch.Tensor)
+                self.assertTrue(np.allclose(out.numpy(), function(x, axis=axis), atol=1e-4))
+                # the input must not be changed, unless we normalize in-place
+                self.assertTrue(np.array_equal(xt.numpy(), x))
+                out = function(xt, axis=axis, inplace=True)
+                self.assertEqual(out.data_ptr(), xt.data_ptr())
+
+    def test_output_dtype(self):
+        import torch
+        from torch_em.transform.raw import normalize, standardize
+
+        x = np.random.rand(4, 32, 32).astype("float32")
+        for function in (normalize, standardize):
+            self.assertEqual(function(x, dtype="float16").dtype, np.dtype("float16"))
+            self.assertEqual(function(torch.from_numpy(x), dtype=torch.bfloat16).dtype, torch.bfloat16)
+            self.assertEqual(function(torch.from_numpy(x), dtype="float16").dtype, torch.float16)
+            self.assertTrue(np.allclose(function(x, dtype="float16"), function(x), atol=1e-2))
+
+    def test_cuda_autocast_dtype(self):
+        import torch
+        from torch_em.transform.raw import _cuda_autocast_dtype
+
+        self.assertIsNone(_cuda_autocast_dtype())
+        # older pytorch versions don't have get_autocast_dtype
+        with mock.patch.dict(torch.__dict__):
+            del torch.__dict__["get_autocast_dtype"]
+            self.assertIsNone(_cuda_autocast_dtype())
+
+    def test_normalize_and_standardize_batch(self):
+        import torch
+        from torch_em.transform.raw import normalize, normalize_batch, standardize, standardize_batch
+
+        x = torch.rand(4, 2, 32, 32) * 10
+        for function, batch_function in [(normalize, normalize_batch), (standardize, standardize_batch)]:
+            expected = torch.stack([function(sample) for sample in x])
+            self.assertTrue(torch.allclose(batch_function(x), expected, atol=1e-5))
+            expected = np.stack([function(sample) for sample in x.numpy()])
+            self.assertTrue(np.allclose(batch_function(x.numpy()), expected, atol=1e-5))
+
+    def test_channel_standardize(self):
+        import torch
+        from torch_em.transform.raw import ChannelStandardize
+
+        mean, std = [0.5, 1.0, 2.0], [0.1, 0.2, 0.3]
+        trafo = ChannelStandardize(mean, std)
+        x = torch.rand(2, 3, 32, 32)
+        expected = (x - torch.tensor(mean)[:, None, None]) / (torch.tensor(std)[:, None, None] + 1e-7)
+        self.assertTrue(torch.allclose(trafo(x), expected, atol=1e-5))
+        self.assertTrue(torch.allclose(trafo(x[0]), expected[0], atol=1e-5))
+
+    def test_normalize_percentile(self):
+        from torch_em.transform.raw import normalize_percentile
+
+        def expected_percentile(x, lower, upper, axis=None):
+            v_lower = np.percentile(x, lower, axis=axis, keepdims=True)
+            v_upper = np.percentile(x, upper, axis=axis, keepdims=True)
+            return (x.astype("float32") - v_lower) / (v_upper - v_lower + 1e-7)
+
+        # 8 and 16 bit data uses the histogram to compute the percentiles
+        for dtype, max_val in [("uint8", 255), ("uint16", 4000), ("float32", 1.0)]:
+            x = (np.random.rand(4, 64, 64) * max_val).astype(dtype)
+            for lower, upper in [(1.0, 99.0), (0.0, 100.0), (2.5, 97.3)]:
+                xt = normalize_percentile(x, lower, upper)
+                self.assertTrue(np.allclose(xt, expected_percentile(x, lower, upper), atol=1e-5))
+            xt = normalize_percentile(x, axis=(1, 2))
+            self.assertTrue(np.allclose(xt, expected_percentile(x, 1.0, 99.0, axis=(1, 2)), atol=1e-5))
+
+    def test_additive_noise(self):
+        import torch
+        from torch_em.transform.raw import AdditiveGaussianNoise, AdditivePoissonNoise, PoissonNoise
+
+        x = np.random.rand(4, 64, 64).astype("float32")
+        x_copy = x.copy()
+        for aug in (AdditiveGaussianNoise(), AdditivePoissonNoise(), PoissonNoise(multiplier=(0.05, 0.1))):
+            for inp in (x, torch.from_numpy(x)):
+                out = aug(inp)
+                self.assertEqual(type(out), type(inp))
+                self.assertEqual(out.dtype, inp.dtype)
+                self.assertEqual(out.shape, inp.shape)
+                self.assertTrue(0 <= out.min() and out.max() <= 1)
+                self.assertFalse(np.allclose(np.asarray(out), x))
+                # the noise is returned in a new array and must not be shared between calls
+                self.assertFalse(np.shares_memory(np.asarray(out), np.asarray(aug(inp))))
+            self.assertTrue(np.array_equal(x, x_copy))
+
+    def test_noise_seed(self):
+        import torch
+        from torch_em.transform.raw import AdditiveGaussianNoise, AdditivePoissonNoise, PoissonNoise
+
+        x = np.random.rand(4, 32, 32).astype("float32")
+        for aug in (AdditiveGaussianNoise(), AdditivePoissonNoise(), PoissonNoise(multiplier=(0.05, 0.1))):
+            # reseeding reproduces the noise, for numpy data via numpy and for tensors via numpy and torch
+            outputs = []
+            for _ in range(2):
+                np.random.seed(0)
+                torch.manual_seed(0)
+                outputs.append((aug(x), aug(x), aug(torch.from_numpy(x))))
+            for first, second in zip(*outputs):
+                self.assertTrue(np.array_equal(np.asarray(first), np.asarray(second)))
+            self.assertFalse(np.array_equal(outputs[0][0], outputs[0][1]))
+
+    def test_noise_dtype(self):
+        import torch
+        from torch_em.transform.raw import AdditiveGaussianNoise, AdditivePoissonNoise, PoissonNoise
+
+        augs = (AdditiveGaussianNoise(), AdditivePoissonNoise(), PoissonNoise(multiplier=(0.05, 0.1)))
+        # float data keeps its dtype, other data is returned as float32
+        for dtype, expected in [("float32", "float32"), ("float64", "float64"), ("uint8", "float32")]:
+            x = (np.random.rand(4, 32, 32) * (255 if dtype == "uint8" else 1)).astype(dtype)
+            for aug in augs:
+                self.assertEqual(aug(x).dtype, np.dtype(expected))
+                self.assertEqual(aug(torch.from_numpy(x)).dtype, getattr(torch, expected))
+
+    def test_intensity_augmentations(self):
+        import torch
+        from torch_em.transform.raw import RandomBrightness, RandomContrast, RandomGamma
+
+        x = np.random.rand(4, 64, 64).astype("float32")
+        for aug in (RandomBrightness(), RandomContrast(), RandomGamma()):
+            out_np, out_torch = aug(x.copy(), alpha=0.7), aug(torch.from_numpy(x), alpha=0.7)
+            self.assertIsInstance(out_torch, torch.Tensor)
+            self.assertTrue(np.allclose(out_np, out_torch.numpy(), atol=1e-6))
+            self.assertTrue(0 <= out_np.min() and out_np.max() <= 1)
+
+        # the contrast augmentation is applied around the mean and clipped to the custom range
+        out = RandomContrast(clip_kwargs={"a_min": 0.25, "a_max": None})(x, alpha=2.0)
+        expected = np.clip(x.mean() + 2.0 * (x - x.mean()), 0.25, None)
+        self.assertTrue(np.allclose(out, expected, atol=1e-6))
+
+    @unittest.skipIf(numexpr is None, "Needs numexpr")
+    def test_numexpr(self):
+        from torch_em.transform.raw import (
+            RandomBrightness, RandomContrast, RandomGamma, normalize_percentile, _use_numexpr, _NUMEXPR_MIN_SIZE
+        )
+
+        # numexpr is used for large arrays, depending on the number of threads set at runtime
+        n_threads = numexpr.get_num_threads()
+        try:
+            numexpr.set_num_threads(2)
+            self.assertTrue(_use_numexpr(np.zeros(_NUMEXPR_MIN_SIZE, dtype="float32")))
+            self.assertFalse(_use_numexpr(np.zeros(16, dtype="float32")))
+            numexpr.set_num_threads(1)
+            self.assertFalse(_use_numexpr(np.zeros(_NUMEXPR_MIN_SIZE, dtype="float32")))
+        finally:
+            numexpr.set_num_threads(n_threads)
+
+        x = np.random.rand(4, 64, 64).astype("float32")
+        augs = (RandomBrightness(), RandomContrast(), RandomGamma(gain=0.8))
+        expected = [aug(x, alpha=0.7) for aug in augs]
+        expected_percentile = [normalize_percentile(x, axis=axis) for axis in (None, (1, 2))]
+        with mock.patch("torch_em.transform.raw._use_numexpr", return_value=True):
+            for axis, exp in zip((None, (1, 2)), expected_percentile):
+                out = normalize_percentile(x, axis=axis)
+                self.assertEqual(out.dtype, np.dtype("float32"))
+                self.assertTrue(np.allclose(out, exp, atol=1e-6))
+            for aug, exp in zip(augs, expected):
+                out = aug(x, alpha=0.7)
+                self.assertEqual(out.dtype, x.dtype)
+                self.assertTrue(np.allclose(out, exp, atol=1e-6))
+
+    def test_gaussian_blur(self):
+        import torch
+        from torchvision import transforms
+        from torch_em.transform.raw import GaussianBlur, _gaussian_kernel1d
+
+        x = torch.rand(2, 64, 64)
+        for kernel_size, sigma in [(3, 0.5), (5, 1.0), (11, 2.5)]:
+            expected = transforms.GaussianBlur(kernel_size, sigma=sigma)(x).numpy()
+            # fix kernel size and sigma by passing ranges that only allow a single value
+            blur = GaussianBlur(kernel_size=(kernel_size, kernel_size + 1), sigma=(sigma, sigma))
+            self.assertTrue(np.allclose(blur(x).numpy(), expected, atol=1e-6))
+            self.assertTrue(np.allclose(blur(x.numpy()), expected, atol=1e-6))
+            blur = GaussianBlur(kernel_size=(kernel_size, kernel_size + 1), sigma=(sigma, sigma), n_kernels=4)
+            self.assertEqual(len(blur.kernels), 4)
+            self.assertTrue(np.allclose(blur(x).numpy(), expected, atol=1e-6))
+
+        # with the default parameters the kernels are reused after a few calls
+        _gaussian_kernel1d.cache_clear()
+        blur = GaussianBlur()
+        for _ in range(1000):
+            blur(x)
+        self.assertLessEqual(_gaussian_kernel1d.cache_info().misses, 250)
+
+    def test_get_raw_augmentations(self):
+        from torch_em.transform.raw import FastRandomApply, GaussianBlur, RandomContrast, get_raw_augmentations
+
+        aug = get_raw_augmentations([
+            ("GaussianBlur", {"p": 0.0}, {}),
+            ("RandomContrast", {"p": 1.0}, {"alpha": (1.0, 1.0)}),
+            ("AdditiveGaussianNoise", {"p": 0.5}, {}),
+        ])
+        # the blur is never applied and the contrast augmentation is always applied
+        self.assertEqual(len(aug.transforms), 3)
+        self.assertFalse(any(isinstance(trafo, GaussianBlur) for trafo in aug.transforms))
+        self.assertIsInstance(aug.transforms[1], RandomContrast)
+        self.assertIsInstance(aug.transforms[2], FastRandomApply)
+        self.assertEqual(aug(np.random.rand(32, 32)).shape, (32, 32))
+
+        with self.assertRaises(AssertionError):
+            get_raw_augmentations([("Unknown", {"p": 1.0}, {})])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,8 @@
 import os
 import pickle
+import queue
+import tempfile
+import threading
 from concurrent import futures
 from glob import glob
 from multiprocessing import cpu_count
@@ -7,11 +10,46 @@ from multiprocessing import cpu_count
 import numpy as np
 import pandas as pd
 import elf.io as io
-from tqdm import tqdm, trange
+from tqdm import tqdm
 
 from .prepare_shallow2deep import _apply_filters, _get_filters
 from .shallow2deep_model import IlastikPredicter
 
+# optional import for blosc compression of the cached predictions in hdf5
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+# the features for visualize_pretrained_rfs are shared with the worker processes via a memmap,
+# so that they are not pickled and sent to the workers for each forest
+_rf_features = None
+_rf_raw_shape = None
+
+
+def _init_rf_worker(feature_path, feature_shape, feature_dtype, raw_shape):
+    global _rf_features, _rf_raw_shape
+    _rf_features = np.memmap(feature_path, dtype=feature_dtype, mode="r", shape=feature_shape)
+    _rf_raw_shape = raw_shape
+
+
+def _predict_rf(rf_path, chunk_size=1_000_000):
+    with open(rf_path, "rb") as f:
+        rf = pickle.load(f)
+    # we parallelize over the forests already, so avoid nested parallelization in sklearn
+    rf.n_jobs = 1
+
+    # predict in chunks of pixels and write the prediction (channel first) to a pre-allocated float32 array,
+    # to avoid materializing the full float64 prediction for all pixels
+    n_pixels = _rf_features.shape[0]
+    pred = np.empty((len(rf.classes_),) + _rf_raw_shape, dtype="float32")
+    flat_pred = pred.reshape(pred.shape[0], -1)
+    assert flat_pred.shape[1] == n_pixels
+    for start in range(0, n_pixels, chunk_size):
+        stop = min(start + chunk_size, n_pixels)
+        flat_pred[:, start:stop] = rf.predict_proba(_rf_features[start:stop]).T
+    return pred
+
 
 def visualize_pretrained_rfs(checkpoint, raw, n_forests,
                              sample_random=False, filter_config=None, n_threads=None):
@@ -23,7 +61,7 @@ def visualize_pretrained_rfs(checkpoint, raw, n_forests,
         n_forests [int] - the number of forests to use
         sample_random [bool] - whether to subsample forests randomly or regularly (default: False)
         filter_config [list] - the filter configuration (default: None)
-        n_threads [int] - number of threads for parallel prediction of forests (default: None)
+        n_threads [int] - number of processes for parallel prediction of forests (default: None)
     """
     import napari
 
@@ -43,18 +81,17 @@ def visualize_pretrained_rfs(checkpoint, raw, n_forests,
     filter_config = _get_filters(raw.ndim, filter_config)
     features = _apply_filters(raw, filter_config)
 
-    def predict_rf(rf_path):
-        with open(rf_path, "rb") as f:
-            rf = pickle.load(f)
-        pred = rf.predict_proba(features)
-        pred = pred.reshape(raw.shape + (pred.shape[1],))
-        pred = np.moveaxis(pred, -1, 0)
-        assert pred.shape[1:] == raw.shape
-        return pred
-
     n_threads = cpu_count() if n_threads is None else n_threads
-    with futures.ThreadPoolExecutor(n_threads) as tp:
-        preds = list(tqdm(tp.map(predict_rf, rf_paths), desc="Predict RFs", total=len(rf_paths)))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        feature_path = os.path.join(tmp_dir, "features.dat")
+        shared_features = np.memmap(feature_path, dtype=features.dtype, mode="w+", shape=features.shape)
+        shared_features[:] = features
+        shared_features.flush()
+        del shared_features
+
+        init_args = (feature_path, features.shape, features.dtype, raw.shape)
+        with futures.ProcessPoolExecutor(n_threads, initializer=_init_rf_worker, initargs=init_args) as pp:
+            preds = list(tqdm(pp.map(_predict_rf, rf_paths), desc="Predict RFs", total=len(rf_paths)))
 
     print("Start viewer")
     v = napari.Viewer()
@@ -66,8 +103,93 @@ def visualize_pretrained_rfs(checkpoint, raw, n_forests,
     napari.run()
 
 
+def _get_chunks(shape):
+    # chunk the cached predictions by 2d slices, so that each chunk corresponds to a single image plane
+    return (1,) * (len(shape) - 2) + tuple(shape[-2:])
+
+
+def _get_compression_kwargs(compression, save_path):
+    # lzf and blosc (via hdf5plugin) are only available for hdf5, other formats (zarr, n5) fall back to gzip
+    is_hdf5 = save_path is not None and os.path.splitext(save_path)[1].lower() in (".h5", ".hdf", ".hdf5")
+    if compression is None:
+        compression = "lzf" if is_hdf5 else "gzip"
+    if compression in ("lzf", "blosc") and save_path is not None and not is_hdf5:
+        raise ValueError(f"The compression {compression} is only supported for hdf5 files, got {save_path}")
+    if compression == "blosc":
+        assert hdf5plugin is not None, "Blosc compression requires hdf5plugin"
+        # zstd with level 1 writes about as fast as lzf, with a compression ratio similar to gzip
+        return dict(hdf5plugin.Blosc(cname="zstd", clevel=1, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    return {"compression": compression}
+
+
+# the cached predictions are probabilities in [0, 1], so we can store them with reduced precision
+def _to_cache_dtype(pred, cache_dtype):
+    pred = np.asarray(pred)
+    if cache_dtype is None:
+        return pred
+    elif np.dtype(cache_dtype) == np.uint8:
+        return (np.clip(pred, 0, 1) * 255).round().astype("uint8")
+    return pred.astype(cache_dtype)
+
+
+def _from_cache_dtype(pred):
+    if pred.dtype == np.uint8:
+        return pred.astype("float32") / 255
+    return pred.astype("float32", copy=False)
+
+
+def _write_cached_predictions(f, write_queue, lock, compression_kwargs, errors):
+    while True:
+        item = write_queue.get()
+        if item is None:
+            return
+        name, pred = item
+        # we keep on consuming the queue after an error, so that the threads that put predictions don't block
+        try:
+            with lock:
+                f.create_dataset(name, data=pred, chunks=_get_chunks(pred.shape), **compression_kwargs)
+        except Exception as e:
+            errors.append(e)
+
+
+def _load_enhancer(enhancer):
+    import bioimageio.core
+    model = bioimageio.core.load_resource_description(enhancer)
+    return bioimageio.core.create_prediction_pipeline(model)
+
+
+def _load_ilastik_predicter(ilp_path, ndim, output_channel):
+    return IlastikPredicter(ilp_path, ndim, ilastik_multi_thread=True, output_channel=output_channel)
+
+
+# enhancers and ilastik projects that were loaded with cache_models=True, so that they are not loaded again
+# if evaluate_enhancers is called several times, e.g. for different data.
+# they are stored together with the modification time of the file, so that changed files are loaded again
+_model_cache = {}
+
+
+def clear_model_cache():
+    """Release the enhancers and ilastik projects cached by evaluate_enhancers(..., cache_models=True).
+    """
+    _model_cache.clear()
+
+
+def _load_model(load_function, path, *args, cache_models=False):
+    # only models saved in a local file can be cached, because we need the modification time to check if they changed
+    if not cache_models or not isinstance(path, (str, os.PathLike)) or not os.path.exists(path):
+        return load_function(path, *args)
+    key = (load_function.__name__, os.fspath(path)) + args
+    mtime = os.path.getmtime(path)
+    cached_mtime, model = _model_cache.get(key, (None, None))
+    if cached_mtime != mtime:
+        model = load_function(path, *args)
+        _model_cache[key] = (mtime, model)
+    return model
+
+
 def evaluate_enhancers(data, labels, enhancers, ilastik_projects, metric,
-                       prediction_function=None, rf_channel=1, is2d=False, save_path=None):
+                       prediction_function=None, rf_channel=1, is2d=False, save_path=None,
+                       compression=None, n_threads=1, cache_dtype="float16", cache_models=False):
     """Evaluate enhancers on ilastik random forests from multiple projects.
 
     Arguments:
@@ -85,104 +207,163 @@ def evaluate_enhancers(data, labels, enhancers, ilastik_projects, metric,
             as input to the enhancer (default: 1)
         is2d [bool] - whether to process 3d data as individual slices and average the scores.
             Is ignored if the data is 2d (default: False)
-        save_path [str] -
+        save_path [str] - path to a file for caching the random forest and enhancer predictions.
+            The predictions are written to it in a background thread (default: None)
+        compression [str] - the compression used for the cached predictions. By default 'lzf' is used for hdf5,
+            which is much faster than 'gzip' at the cost of slightly larger files, and 'gzip' for other formats.
+            'blosc' (requires hdf5plugin) is similarly fast as 'lzf' and compresses as well as 'gzip'.
+            Note that 'lzf' and 'blosc' are only available for hdf5. (default: None)
+        n_threads [int] - number of threads for processing the slices in parallel if is2d is True.
+            Note that all threads share the enhancer models and ilastik projects (default: 1)
+        cache_dtype [str] - the data type for the cached predictions. Can be 'float16', 'uint8'
+            (probabilities are quantized to 0-255) or None to store them without conversion.
+            Cached predictions are converted back to float32 when they are loaded (default: "float16")
+        cache_models [bool] - whether to keep the loaded enhancers and ilastik projects in memory and reuse them
+            in subsequent calls. They are loaded again if their file has changed in the meantime.
+            Use clear_model_cache to release them (default: False)
     Returns:
         [pd.DataFrame] - a table with the scores of the enhancers for the different forests
             and scores of the raw forest predictions
     """
-    import bioimageio.core
     import xarray
 
     assert data.shape == labels.shape
     ndim = data.ndim
     model_ndim = 2 if (data.ndim == 2 or is2d) else 3
-
-    def load_enhancer(enh):
-        model = bioimageio.core.load_resource_description(enh)
-        return bioimageio.core.create_prediction_pipeline(model)
+    compression_kwargs = _get_compression_kwargs(compression, save_path)
+    # the dimensions of the predictions, with an additional batch and channel axis.
+    # they are the same for all chunks, so we only determine them once here
+    dims = ("b", "c") + tuple("yx" if model_ndim == 2 else "zyx")
 
     # load the enhancers
-    models = {name: load_enhancer(enh) for name, enh in enhancers.items()}
+    models = {name: _load_model(_load_enhancer, enh, cache_models=cache_models) for name, enh in enhancers.items()}
 
-    # load the ilps
+    # load the ilps (the channels need to be hashable for caching the ilastik predicter)
+    rf_channel = tuple(rf_channel) if isinstance(rf_channel, list) else rf_channel
     ilps = {
-        name: IlastikPredicter(path, model_ndim, ilastik_multi_thread=True, output_channel=rf_channel)
+        name: _load_model(_load_ilastik_predicter, path, model_ndim, rf_channel, cache_models=cache_models)
         for name, path in ilastik_projects.items()
     }
 
-    def require_rf_prediction(rf, input_, name, axes):
+    # h5py is not thread-safe, so we need to lock all file access if we process slices in parallel
+    lock = threading.Lock()
+    # the cached predictions are written by a separate thread, so that the computation of the next predictions
+    # does not wait for the compression and writing. the queue size limits the number of predictions held in memory
+    write_queue = queue.Queue(maxsize=2 * n_threads)
+
+    def load_cached_prediction(name):
+        with lock:
+            pred = f[name][:] if name in f else None
+        return None if pred is None else _from_cache_dtype(pred)
+
+    # returns the prediction as it would be loaded from the cache,
+    # so that the results don't depend on whether the predictions were already cached
+    def save_cached_prediction(name, pred):
+        pred = _to_cache_dtype(pred, cache_dtype)
+        write_queue.put((name, pred))
+        return _from_cache_dtype(pred)
+
+    def require_rf_prediction(rf, input_, name):
         if save_path is None:
             return rf(input_)
-        with io.open_file(save_path, "a") as f:
-            if name in f:
-                pred = f[name][:]
-            else:
-                pred = rf(input_)
-                # require len(axes) + 2 dimensions (additional batch and channel axis)
-                pred = pred[(None,) * (len(axes) + 2 - pred.ndim)]
-                assert pred.ndim == len(axes) + 2, f"{pred.ndim}, {len(axes) + 2}"
-                f.create_dataset(name, data=pred, compression="gzip")
-            return pred
+        pred = load_cached_prediction(name)
+        if pred is None:
+            pred = rf(input_)
+            # require the additional batch and channel axis
+            pred = pred[(None,) * (len(dims) - pred.ndim)]
+            assert pred.ndim == len(dims), f"{pred.ndim}, {len(dims)}"
+            pred = save_cached_prediction(name, pred)
+        return pred
 
-    def require_enh_prediction(enh, rf_pred, name, prediction_function, axes):
+    def require_enh_prediction(enh, rf_pred, name):
         if save_path is None:
             pred = enh(rf_pred) if prediction_function is None else prediction_function(enh, rf_pred)
             pred = pred[0]
             return pred
-        with io.open_file(save_path, "a") as f:
-            if name in f:
-                pred = f[name][:]
-            else:
-                rf_pred = xarray.DataArray(rf_pred, dims=("b", "c",) + tuple(axes))
-                pred = enh(rf_pred) if prediction_function is None else prediction_function(enh, rf_pred)
-                pred = pred[0]
-                f.create_dataset(name, data=pred, compression="gzip")
-            return pred
+        pred = load_cached_prediction(name)
+        # we only wrap the input in a DataArray if the prediction is not cached
+        if pred is None:
+            rf_pred = xarray.DataArray(rf_pred, dims=dims)
+            pred = enh(rf_pred) if prediction_function is None else prediction_function(enh, rf_pred)
+            pred = pred[0]
+            pred = save_cached_prediction(name, pred)
+        return pred
 
-    def process_chunk(x, y, axes, z=None):
-        scores = np.zeros((len(models) + 1, len(ilps)))
-        for i, (rf_name, ilp) in enumerate(ilps.items()):
+    # the names of the table rows (enhancers + rf score) and columns (ilastik projects)
+    model_names = list(models.keys()) + ["rf-score"]
+    ilp_names = list(ilps.keys())
+    model_items, ilp_items = list(models.items()), list(ilps.items())
+
+    # the scores are written to a pre-allocated array, so that we only need to create a single table at the end
+    def process_chunk(x, y, scores, z=None):
+        for i, (rf_name, ilp) in enumerate(ilp_items):
             rf_pred = require_rf_prediction(
                 ilp, x,
                 rf_name if z is None else f"{rf_name}/{z:04}",
-                axes
             )
-            for j, (enh_name, enh) in enumerate(models.items()):
+            for j, (enh_name, enh) in enumerate(model_items):
                 pred = require_enh_prediction(
                     enh, rf_pred,
                     f"{enh_name}/{rf_name}" if z is None else f"{enh_name}/{rf_name}/{z:04}",
-                    prediction_function,
-                    axes
                 )
                 score = metric(pred, y)
                 scores[j, i] = score
             score = metric(rf_pred, y)
             scores[-1, i] = score
 
-        scores = pd.DataFrame(scores, columns=list(ilps.keys()))
-        scores.insert(loc=0, column="enhancer", value=list(models.keys()) + ["rf-score"])
+    def to_table(scores):
+        return pd.DataFrame(scores, columns=ilp_names).assign(enhancer=model_names)[["enhancer"] + ilp_names]
+
+    def compute_scores():
+        scores_shape = (len(model_names), len(ilp_names))
+        # if we have 2d data, or 3d data that is processed en block,
+        # we only have to process a single 'chunk'
+        if ndim == 2 or (ndim == 3 and not is2d):
+            scores = np.zeros(scores_shape)
+            process_chunk(data, labels, scores)
+            scores = to_table(scores)
+        elif ndim == 3 and is2d:
+            n_slices = data.shape[0]
+            scores = np.zeros((n_slices,) + scores_shape)
+
+            def process_slice(z):
+                process_chunk(data[z], labels[z], scores[z], z)
+
+            with futures.ThreadPoolExecutor(n_threads) as tp:
+                list(tqdm(tp.map(process_slice, range(n_slices)), total=n_slices))
+            scores = to_table(scores.mean(axis=0)).set_index("enhancer")
+        else:
+            raise ValueError("Invalid data dimensions: {ndim}")
         return scores
 
-    # if we have 2d data, or 3d data that is processed en block,
-    # we only have to process a single 'chunk'
-    if ndim == 2 or (ndim == 3 and not is2d):
-        scores = process_chunk(data, labels, "yx" if ndim == 2 else "zyx")
-    elif ndim == 3 and is2d:
-        scores = []
-        for z in trange(data.shape[0]):
-            scores_z = process_chunk(data[z], labels[z], "yx", z)
-            scores.append(scores_z)
-        scores = pd.concat(scores).groupby("enhancer").mean()
-    else:
-        raise ValueError("Invalid data dimensions: {ndim}")
+    if save_path is None:
+        return compute_scores()
+
+    # open the file for the cached predictions only once, and write to it from the writer thread
+    write_errors = []
+    with io.open_file(save_path, "a") as f:
+        writer = threading.Thread(
+            target=_write_cached_predictions, args=(f, write_queue, lock, compression_kwargs, write_errors)
+        )
+        writer.start()
+        try:
+            scores = compute_scores()
+        finally:
+            write_queue.put(None)
+            writer.join()
+    if write_errors:
+        raise write_errors[0]
 
     return scores
 
 
 def load_predictions(save_path, n_threads=1):
     """Helper functions to load predictions from a save_path created by evaluate_enhancers
+
+    Predictions that were cached with reduced precision are returned as float32.
     """
     predictions = {}
+    slice_datasets = {}
 
     def visit(name, node):
         if io.is_group(node):
@@ -192,23 +373,24 @@ def load_predictions(save_path, n_threads=1):
         try:
             data_name = "/".join(name.split("/")[:-1])
             z = int(name.split("/")[-1])
-            data = node[:]
-            pred = predictions.get(data_name, {})
-            pred[z] = data
-            predictions[data_name] = pred
+            slices = slice_datasets.get(data_name, {})
+            slices[z] = node
+            slice_datasets[data_name] = slices
         # otherwise the above will throw a val error and we just load the array
         except ValueError:
-            predictions[name] = node[:]
+            predictions[name] = _from_cache_dtype(node[:])
+
+    # load the slices directly into the pre-allocated volume, instead of loading all slices
+    # first and then concatenating them, which would need twice the memory
+    def to_vol(slices):
+        slices = [slices[z] for z in sorted(slices)]
+        vol = np.empty((len(slices),) + slices[0].shape, dtype="float32")
+        for z, ds in enumerate(slices):
+            vol[z] = _from_cache_dtype(ds[:])
+        return vol
 
     with io.open_file(save_path, "r") as f:
         f.visititems(visit)
-
-    def to_vol(pred):
-        if isinstance(pred, np.ndarray):
-            return pred
-        pred = dict(sorted(pred.items()))
-        return np.concatenate([pz[None] for pz in pred.values()], axis=0)
-
-    predictions = {name: to_vol(pred) for name, pred in predictions.items()}
+        predictions.update({name: to_vol(slices) for name, slices in slice_datasets.items()})
 
     return predictions
@@ -18,9 +18,21 @@ from .tensorboard_logger import TensorboardLogger
 from .wandb_logger import WandbLogger
 from ..util import get_constructor_arguments
 
+try:
+    import safetensors.torch as safetensors_torch
+except ImportError:
+    safetensors_torch = None
+
 
 class DefaultTrainer:
-    """Trainer class for 2d/3d training on a single GPU."""
+    """Trainer class for 2d/3d training on a single GPU.
+
+    The batches are copied to the device asynchronously, so using loaders with `pin_memory=True`
+    is recommended for training on the GPU.
+
+    If `use_safetensors` is set, the model weights are saved in a separate safetensors file next to the
+    checkpoint, which is faster to write and to load for large models.
+    """
 
     def __init__(
         self,
@@ -40,6 +52,8 @@ class DefaultTrainer:
         logger_kwargs: Optional[Dict[str, Any]] = None,
         id_: Optional[str] = None,
         save_root: Optional[str] = None,
+        compile_model: bool = False,
+        use_safetensors: bool = False,
     ):
         if name is None and not issubclass(logger, WandbLogger):
             raise TypeError("Name cannot be None if not using the WandbLogger")
@@ -62,6 +76,10 @@ class DefaultTrainer:
         self.lr_scheduler = lr_scheduler
         self.log_image_interval = log_image_interval
         self.save_root = save_root
+        self.compile_model = compile_model
+        if use_safetensors and safetensors_torch is None:
+            raise RuntimeError("Saving checkpoints with safetensors requires the safetensors package")
+        self.use_safetensors = use_safetensors
 
         self._iteration = 0
         self._epoch = 0
@@ -219,7 +237,29 @@ class DefaultTrainer:
         if not os.path.exists(save_path):
             raise ValueError(f"Cannot find checkpoint {save_path}")
 
-        return torch.load(save_path, map_location=device)
+        load_params = inspect.signature(torch.load).parameters
+        # the checkpoint also contains the pickled init data (e.g. the datasets),
+        # so we cannot restrict loading to the weights only
+        load_kwargs = {"weights_only": False} if "weights_only" in load_params else {}
+        # memory-map the checkpoint instead of reading it into memory at once (supported for pytorch >= 2.1)
+        if "mmap" in load_params:
+            load_kwargs["mmap"] = True
+        save_dict = torch.load(save_path, map_location=device, **load_kwargs)
+
+        # load the state dicts that were saved separately with safetensors
+        safetensors_keys = save_dict.pop("safetensors_keys", None)
+        if safetensors_keys:
+            assert safetensors_torch is not None, "Loading this checkpoint requires the safetensors package"
+            tensors = safetensors_torch.load_file(
+                os.path.splitext(save_path)[0] + ".safetensors", device="cpu" if device is None else str(device)
+            )
+            for key in safetensors_keys:
+                prefix = f"{key}/"
+                save_dict[key] = {
+                    name[len(prefix):]: tensor for name, tensor in tensors.items() if name.startswith(prefix)
+                }
+
+        return save_dict
 
     @classmethod
     def from_checkpoint(cls, checkpoint_folder, name="best", device=None):
@@ -428,6 +468,12 @@ class DefaultTrainer:
         self.model.to(self.device)
         self.loss.to(self.device)
 
+        # compile the forward pass and loss computation to reduce the python and kernel launch overhead
+        if self.compile_model and getattr(self, "_compiled_pred_and_loss", None) is None:
+            if not hasattr(torch, "compile"):
+                raise RuntimeError("Compiling the model requires pytorch >= 2.0")
+            self._compiled_pred_and_loss = torch.compile(self._pred_and_loss, dynamic=False)
+
         # this saves all the information that is necessary
         # to fully load the trainer from the checkpoint
         self.init_data = self._build_init()
@@ -462,7 +508,28 @@ class DefaultTrainer:
             save_dict.update({"scaler_state": self.scaler.state_dict()})
         if self.lr_scheduler is not None:
             save_dict.update({"scheduler_state": self.lr_scheduler.state_dict()})
-        torch.save(save_dict, save_path)
+
+        # save the state dicts that only contain tensors (e.g. the model weights) with safetensors
+        if self.use_safetensors:
+            safetensors_keys = [
+                key for key, state in save_dict.items()
+                if isinstance(state, dict) and state and all(torch.is_tensor(val) for val in state.values())
+            ]
+            tensors = {
+                f"{key}/{name}": tensor.contiguous()
+                for key in safetensors_keys for name, tensor in save_dict.pop(key).items()
+            }
+            save_dict["safetensors_keys"] = safetensors_keys
+            tensor_path = os.path.splitext(save_path)[0] + ".safetensors"
+            tmp_path = f"{tensor_path}.tmp"
+            safetensors_torch.save_file(tensors, tmp_path)
+            os.replace(tmp_path, tensor_path)
+
+        # checkpoints are loaded memory-mapped, so we must not overwrite the file in place:
+        # save to a temporary file and then replace the checkpoint with it
+        tmp_path = f"{save_path}.tmp"
+        torch.save(save_dict, tmp_path)
+        os.replace(tmp_path, save_path)
 
     def load_checkpoint(self, checkpoint="best"):
         if isinstance(checkpoint, str):
@@ -470,7 +537,7 @@ class DefaultTrainer:
             if not os.path.exists(save_path):
                 warnings.warn(f"Cannot load checkpoint. {save_path} does not exist.")
                 return
-            save_dict = torch.load(save_path)
+            save_dict = self._get_save_dict(save_path, self.device)
         elif isinstance(checkpoint, dict):
             save_dict = checkpoint
         else:
@@ -579,8 +646,18 @@ class DefaultTrainer:
     def _train_epoch_mixed(self, progress):
         return self._train_epoch_impl(progress, amp.autocast, self._backprop_mixed)
 
-    def _forward_and_loss(self, x, y):
+    def _pred_and_loss(self, x, y):
         pred = self.model(x)
+        loss = self.loss(pred, y)
+        return pred, loss
+
+    def _forward_and_loss(self, x, y):
+        if self.compile_model:
+            pred, loss = self._compiled_pred_and_loss(x, y)
+        else:
+            pred, loss = self._pred_and_loss(x, y)
+
+        # retaining the gradient is done outside of the compiled function, to avoid recompilation
         if (
             self.log_image_interval > 0
             and self._iteration % self.log_image_interval == 0
@@ -588,9 +665,50 @@ class DefaultTrainer:
             if pred.requires_grad:
                 pred.retain_grad()
 
-        loss = self.loss(pred, y)
         return pred, loss
 
+    class _Prefetcher:
+        """Iterate over a loader and copy the next batch to the device while the current batch is processed.
+
+        On the GPU the next batch is copied on a separate CUDA stream, so that the copy overlaps
+        with the computation on the current stream. Otherwise the batches are just moved to the device.
+        """
+
+        def __init__(self, loader, device):
+            self.loader = loader
+            self.device = torch.device(device)
+            self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+        def _to_device(self, batch):
+            return tuple(tensor.to(self.device, non_blocking=True) for tensor in batch)
+
+        def _prefetch(self, loader_iter):
+            try:
+                batch = next(loader_iter)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(self.stream):
+                return self._to_device(batch)
+
+        def __iter__(self):
+            if self.stream is None:
+                for batch in self.loader:
+                    yield self._to_device(batch)
+                return
+
+            loader_iter = iter(self.loader)
+            next_batch = self._prefetch(loader_iter)
+            while next_batch is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                batch = next_batch
+                # the batch was allocated on the prefetch stream, so we need to make sure
+                # that its memory is not reused before the computation on the current stream is done
+                for tensor in batch:
+                    tensor.record_stream(current_stream)
+                next_batch = self._prefetch(loader_iter)
+                yield batch
+
     def _train_epoch_impl(
         self,
         progress,
@@ -601,10 +719,8 @@ class DefaultTrainer:
 
         n_iter = 0
         t_per_iter = time.time()
-        for x, y in self.train_loader:
-            x, y = x.to(self.device), y.to(self.device)
-
-            self.optimizer.zero_grad()
+        for x, y in self._Prefetcher(self.train_loader, self.device):
+            self.optimizer.zero_grad(set_to_none=True)
 
             with forward_context():
                 pred, loss = self._forward_and_loss(x, y)
@@ -635,23 +751,26 @@ class DefaultTrainer:
     def _validate_impl(self, forward_context):
         self.model.eval()
 
-        metric_val = 0.0
-        loss_val = 0.0
+        # accumulate loss and metric on the device, so that we only need to synchronize once after the loop
+        metric_val = torch.zeros((), device=self.device)
+        loss_val = torch.zeros((), device=self.device)
 
-        with torch.no_grad():
-            for x, y in self.val_loader:
-                x, y = x.to(self.device), y.to(self.device)
+        # inference mode skips the autograd bookkeeping (version counters and view tracking) that no_grad keeps
+        with torch.inference_mode():
+            for x, y in self._Prefetcher(self.val_loader, self.device):
                 with forward_context():
                     pred, loss = self._forward_and_loss(x, y)
                     metric = self.metric(pred, y)
 
-                loss_val += loss.item()
-                metric_val += metric.item()
+                loss_val += loss
+                metric_val += metric
 
-        metric_val /= len(self.val_loader)
-        loss_val /= len(self.val_loader)
-        if self.logger is not None:
-            self.logger.log_validation(
-                self._iteration, metric_val, loss_val, x, y, pred
-            )
+            metric_val = metric_val.item() / len(self.val_loader)
+            loss_val = loss_val.item() / len(self.val_loader)
+            # the logger is called in inference mode too, because the tensors created in inference mode
+            # cannot be updated in-place outside of it (which the loggers may do when normalizing the images)
+            if self.logger is not None:
+                self.logger.log_validation(
+                    self._iteration, metric_val, loss_val, x, y, pred
+                )
         return metric_val
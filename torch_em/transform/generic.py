@@ -11,21 +11,15 @@ class Tile(torch.nn.Module):
 
     def __init__(self, reps: Sequence[int] = (2,), match_shape_exactly: bool = True):
         super().__init__()
-        self.reps = reps
+        self.reps = tuple(reps)
         self.match_shape_exactly = match_shape_exactly
 
     def forward(self, input: Union[torch.Tensor, np.ndarray], params: Optional[Dict[str, Any]] = None):
         assert not self.match_shape_exactly or len(input.shape) == len(self.reps), (input.shape, self.reps)
+        # torch.tile and np.tile both prepend singleton reps / axes if the number of reps
+        # and the number of input dimensions do not match
         if isinstance(input, torch.Tensor):
-            # return torch.tile(input, self.reps)  # todo: use torch.tile (for pytorch >=1.8?)
-            reps = list(self.reps)
-            for _ in range(max(0, len(input.shape) - len(reps))):
-                reps.insert(0, 1)
-
-            for _ in range(max(0, len(reps) - len(input.shape))):
-                input = input.unsqueeze(0)
-
-            return input.repeat(*reps)
+            return torch.tile(input, self.reps)
         elif isinstance(input, np.ndarray):
             return np.tile(input, self.reps)
         else:
@@ -37,10 +31,18 @@ class Compose:
     def __init__(self, *transforms):
         self.transforms = transforms
 
+    def __len__(self):
+        return len(self.transforms)
+
+    def __iter__(self):
+        return iter(self.transforms)
+
     def __call__(self, *inputs):
         outputs = self.transforms[0](*inputs)
         for trafo in self.transforms[1:]:
-            outputs = trafo(*outputs)
+            # only unpack the outputs if the previous transform returned multiple outputs,
+            # transforms with a single output (e.g. Rescale for a single input) return the array directly
+            outputs = trafo(*outputs) if isinstance(outputs, tuple) else trafo(outputs)
         return outputs
 
 
@@ -50,8 +52,8 @@ class Rescale:
         self.with_channels = with_channels
 
     def _rescale_with_channels(self, input_, **kwargs):
-        out = [rescale(inp, **kwargs)[None] for inp in input_]
-        return np.concatenate(out, axis=0)
+        # rescale all channels in a single call instead of looping over them
+        return rescale(input_, channel_axis=0, **kwargs)
 
     def __call__(self, *inputs):
         if self.with_channels is None:
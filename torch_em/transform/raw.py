@@ -1,28 +1,26 @@
+from functools import lru_cache, partial
+
 import numpy as np
 import torch
+import torch.nn.functional as F
+from scipy.ndimage import correlate1d
 from torchvision import transforms
 from ..util import ensure_tensor
 
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
 
 #
 # normalization functions
 #
 
 
-def standardize(raw, mean=None, std=None, axis=None, eps=1e-7):
-    raw = raw.astype("float32")
-
-    mean = raw.mean(axis=axis, keepdims=True) if mean is None else mean
-    raw -= mean
-
-    std = raw.std(axis=axis, keepdims=True) if std is None else std
-    raw /= std + eps
-
-    return raw
-
-
 TORCH_DTYPES = {
     "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
     "float32": torch.float32,
     "float64": torch.float64,
     "complex64": torch.complex64,
@@ -37,51 +35,260 @@ TORCH_DTYPES = {
 
 
 def cast(inpt, typestring):
+    # the input is returned as is if it already has the requested dtype
     if torch.is_tensor(inpt):
-        assert typestring in TORCH_DTYPES, f"{typestring} not in TORCH_DTYPES"
-        return inpt.to(TORCH_DTYPES[typestring])
-    return inpt.astype(typestring)
+        dtype = TORCH_DTYPES.get(typestring)
+        assert dtype is not None, f"{typestring} not in TORCH_DTYPES"
+        return inpt if inpt.dtype is dtype else inpt.to(dtype)
+    return inpt.astype(typestring, copy=False)
 
 
-def _normalize_torch(tensor, minval=None, maxval=None, axis=None, eps=1e-7):
-    if axis:  # torch returns torch.return_types.min or torch.return_types.max
-        minval = tensor.min(dim=axis, keepdim=True).values if minval is None else minval
-        tensor -= minval
+cast_float32 = partial(cast, typestring="float32")
 
-        maxval = tensor.max(dim=axis, keepdim=True).values if maxval is None else maxval
-        tensor /= maxval + eps
 
-        return tensor
+def _to_float32(raw, inplace):
+    # only skip the copy for float32 data if we normalize in-place, otherwise the input would be changed.
+    # if we copy, we make the copy C-contiguous, so that reductions over the last axes (e.g. per channel)
+    # run over contiguous memory, even if the input is a strided view (e.g. channel last data moved to channel first)
+    if torch.is_tensor(raw):
+        if inplace:
+            return raw.to(torch.float32)
+        return raw.to(torch.float32, copy=True, memory_format=torch.contiguous_format)
+    if inplace:
+        return raw.astype("float32", copy=False)
+    return raw.astype("float32", order="C")
+
+
+def _as_tensor_stat(val, tensor):
+    # move statistics given as arrays (e.g. from np.percentile) to the device of the tensor.
+    # python scalars are kept, because torch can use them directly without a host to device copy
+    if isinstance(val, np.ndarray):
+        return torch.as_tensor(val, dtype=tensor.dtype, device=tensor.device)
+    elif torch.is_tensor(val):
+        return val.to(device=tensor.device, non_blocking=True)
+    return val
 
-    # keepdim can only be used in combination with dim
-    minval = tensor.min() if minval is None else minval
-    tensor -= minval
 
-    maxval = tensor.max() if maxval is None else maxval
-    tensor /= maxval + eps
+def _inverse(scale, eps):
+    # we multiply with the inverse of the scale instead of dividing by it, because
+    # a single division and multiplying every element is faster than dividing every element
+    scale = scale + eps
+    return scale.reciprocal() if torch.is_tensor(scale) else 1.0 / scale
+
+
+def _torch_dim(axis):
+    return tuple(axis) if isinstance(axis, list) else axis
+
+
+def _centered_std(raw, axis):
+    # the standard deviation of data that was already centered, i.e. the root mean square.
+    # this avoids computing the mean again (and the temporary for subtracting it) as in raw.std
+    # the mean of the squares is accumulated in float64, otherwise the result is inaccurate for large volumes
+    return np.sqrt(np.mean(np.square(raw), axis=axis, keepdims=True, dtype="float64")).astype("float32")
+
+
+def _standardize_torch(tensor, mean=None, std=None, axis=None, eps=1e-7):
+    dim = _torch_dim(axis)
+    mean = tensor.mean(dim=dim, keepdim=True) if mean is None else _as_tensor_stat(mean, tensor)
+    tensor -= mean
+
+    if std is None:
+        # torch.std is accurate for large tensors, unlike computing the norm of the centered data in float32
+        std = tensor.std(dim=dim, keepdim=True, correction=0)
+    else:
+        std = _as_tensor_stat(std, tensor)
+    tensor *= _inverse(std, eps)
 
     return tensor
 
 
-def normalize(raw, minval=None, maxval=None, axis=None, eps=1e-7):
-    raw = cast(raw, "float32")
+def _standardize_numpy(raw, mean=None, std=None, axis=None, eps=1e-7):
+    compute_mean = mean is None
+    mean = raw.mean(axis=axis, keepdims=True) if compute_mean else mean
+    raw -= mean
+
+    if std is None:
+        # if the mean was computed from the data then it is centered now, and we can compute std in a single pass
+        std = _centered_std(raw, axis) if compute_mean else raw.std(axis=axis, keepdims=True)
+    raw *= _inverse(std, eps)
+
+    return raw
+
+
+def _cuda_autocast_dtype():
+    # is_autocast_enabled and get_autocast_dtype only accept a device type in newer pytorch versions (2.4+)
+    if hasattr(torch, "get_autocast_dtype"):
+        return torch.get_autocast_dtype("cuda") if torch.is_autocast_enabled("cuda") else None
+    return torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else None
 
+
+def _output_dtype(raw, dtype):
+    # the statistics are always computed in float32, but the output can be converted to a different dtype.
+    # by default we return float32, unless the input is on the gpu and autocast is enabled,
+    # in which case we return the autocast dtype (float16 or bfloat16) that the model will use
     if torch.is_tensor(raw):
-        return _normalize_torch(raw, minval=minval, maxval=maxval, axis=axis, eps=eps)
+        if dtype is None and raw.is_cuda:
+            dtype = _cuda_autocast_dtype()
+        dtype = TORCH_DTYPES[dtype] if isinstance(dtype, str) else dtype
+        return None if dtype == torch.float32 else dtype
+    return None if dtype is None or np.dtype(dtype) == np.float32 else np.dtype(dtype)
+
+
+def _to_output_dtype(raw, dtype):
+    if dtype is None:
+        return raw
+    return raw.to(dtype) if torch.is_tensor(raw) else raw.astype(dtype)
+
+
+def standardize(raw, mean=None, std=None, axis=None, eps=1e-7, inplace=False, dtype=None):
+    dtype = _output_dtype(raw, dtype)
+    raw = _to_float32(raw, inplace)
+    standardize_impl = _standardize_torch if torch.is_tensor(raw) else _standardize_numpy
+    raw = standardize_impl(raw, mean=mean, std=std, axis=axis, eps=eps)
+    return _to_output_dtype(raw, dtype)
+
+
+# numexpr evaluates elementwise expressions (normalization, augmentations) in a single multi-threaded pass.
+# this only pays off for large arrays and when numexpr runs with more than one thread
+_NUMEXPR_MIN_SIZE = 2 ** 20
+
+
+def _use_numexpr(img, transcendental=False):
+    if numexpr is None or not isinstance(img, np.ndarray) or img.dtype not in (np.float32, np.float64):
+        return False
+    if img.size < _NUMEXPR_MIN_SIZE or numexpr.get_num_threads() < 2:
+        return False
+    # without VML numexpr does not vectorize transcendental functions and is slower than numpy for them
+    return numexpr.use_vml or not transcendental
+
+
+def _evaluate(expression, img, **scalars):
+    # cast the scalars to the image dtype, otherwise numexpr upcasts float32 to float64
+    local_dict = {name: img.dtype.type(value) for name, value in scalars.items()}
+    local_dict["img"] = img
+    return numexpr.evaluate(expression, local_dict=local_dict)
+
+
+# for integer data we compute min and max on the data directly, which needs to read less memory than
+# computing them on a float32 copy, and fuse the conversion to float32 into the subtraction.
+# strided integer data goes through the float32 copy instead, which is made contiguous (see _to_float32)
+def _is_integer_array(raw):
+    return isinstance(raw, np.ndarray) and np.issubdtype(raw.dtype, np.integer) and raw.flags.c_contiguous
+
+
+def _normalize_fused(raw, minval, maxval, eps):
+    # normalize numpy data with given statistics into a new float32 array.
+    # with numexpr this is a single pass, otherwise the conversion to float32 is fused into the subtraction
+    if _use_numexpr(raw) and raw.dtype == np.float32:
+        minval, inv = np.asarray(minval, dtype="float32"), np.asarray(_inverse(maxval, eps), dtype="float32")
+        return numexpr.evaluate("(raw - minval) * inv", local_dict={"raw": raw, "minval": minval, "inv": inv})
+    raw = np.subtract(raw, minval, dtype="float32", order="C")
+    raw *= _inverse(maxval, eps)
+    return raw
+
+
+def _normalize_integer(raw, minval, maxval, axis, eps):
+    minval = raw.min(axis=axis, keepdims=True).astype("float32") if minval is None else minval
+    maxval = raw.max(axis=axis, keepdims=True).astype("float32") - minval if maxval is None else maxval
+    return _normalize_fused(raw, minval, maxval, eps)
+
+
+def _normalize_torch(tensor, minval=None, maxval=None, axis=None, eps=1e-7):
+    dim = _torch_dim(axis)
+    minval = tensor.amin(dim=dim, keepdim=True) if minval is None else _as_tensor_stat(minval, tensor)
+    tensor -= minval
+
+    maxval = tensor.amax(dim=dim, keepdim=True) if maxval is None else _as_tensor_stat(maxval, tensor)
+    tensor *= _inverse(maxval, eps)
+
+    return tensor
 
+
+def _normalize_numpy(raw, minval=None, maxval=None, axis=None, eps=1e-7):
     minval = raw.min(axis=axis, keepdims=True) if minval is None else minval
     raw -= minval
 
     maxval = raw.max(axis=axis, keepdims=True) if maxval is None else maxval
-    raw /= maxval + eps
+    raw *= _inverse(maxval, eps)
 
     return raw
 
 
+def normalize(raw, minval=None, maxval=None, axis=None, eps=1e-7, inplace=False, dtype=None):
+    dtype = _output_dtype(raw, dtype)
+    if _is_integer_array(raw):
+        raw = _normalize_integer(raw, minval, maxval, axis, eps)
+    else:
+        raw = _to_float32(raw, inplace)
+        normalize_impl = _normalize_torch if torch.is_tensor(raw) else _normalize_numpy
+        raw = normalize_impl(raw, minval=minval, maxval=maxval, axis=axis, eps=eps)
+    return _to_output_dtype(raw, dtype)
+
+
+class ChannelStandardize(torch.nn.Module):
+    """
+    Standardize the channels of a tensor with fixed per-channel mean and standard deviation.
+
+    The statistics are stored as buffers, so they are moved to the device of the tensors once
+    together with the module (via .to), instead of being converted for every call.
+    Expects tensors with the channel axis before the ndim spatial axes, e.g. (C, H, W) or (N, C, H, W) for ndim=2.
+    """
+
+    def __init__(self, mean, std, ndim=2, eps=1e-7):
+        super().__init__()
+        shape = (-1,) + (1,) * ndim
+        mean = torch.as_tensor(mean, dtype=torch.float32).reshape(shape)
+        inv_std = 1.0 / (torch.as_tensor(std, dtype=torch.float32).reshape(shape) + eps)
+        self.register_buffer("mean", mean)
+        self.register_buffer("inv_std", inv_std)
+
+    def forward(self, x):
+        return (x - self.mean).mul_(self.inv_std)
+
+
+# normalize all samples of a batch (e.g. a batch on the gpu) in a single call instead of normalizing each sample.
+# the statistics are computed per sample, over all axes but the first (batch) axis by default
+def _batch_axis(batch, axis):
+    return tuple(range(1, batch.ndim)) if axis is None else axis
+
+
+def standardize_batch(batch, mean=None, std=None, axis=None, eps=1e-7, inplace=False, dtype=None):
+    return standardize(
+        batch, mean=mean, std=std, axis=_batch_axis(batch, axis), eps=eps, inplace=inplace, dtype=dtype
+    )
+
+
+def normalize_batch(batch, minval=None, maxval=None, axis=None, eps=1e-7, inplace=False, dtype=None):
+    return normalize(
+        batch, minval=minval, maxval=maxval, axis=_batch_axis(batch, axis), eps=eps, inplace=inplace, dtype=dtype
+    )
+
+
+def _percentile_from_histogram(raw, q):
+    # compute the percentiles of integer data from the cumulative histogram instead of sorting the data.
+    # this gives the same result as np.percentile with the default 'linear' method
+    cdf = np.cumsum(np.bincount(raw.ravel()))
+    n = cdf[-1]
+    index = np.asarray(q) / 100.0 * (n - 1)
+    index_lower = np.floor(index).astype("int64")
+    index_upper = np.minimum(index_lower + 1, n - 1)
+    # the value at position i of the sorted data is the first value whose cumulative count is larger than i
+    v_lower = np.searchsorted(cdf, index_lower, side="right")
+    v_upper = np.searchsorted(cdf, index_upper, side="right")
+    percentiles = v_lower + (index - index_lower) * (v_upper - v_lower)
+    return percentiles.reshape((len(percentiles),) + (1,) * raw.ndim)
+
+
 def normalize_percentile(raw, lower=1.0, upper=99.0, axis=None, eps=1e-7):
-    v_lower = np.percentile(raw, lower, axis=axis, keepdims=True)
-    v_upper = np.percentile(raw, upper, axis=axis, keepdims=True) - v_lower
-    return normalize(raw, v_lower, v_upper, eps=eps)
+    # compute both percentiles at once, so that the data is only partitioned once,
+    # and use the histogram for 8 and 16 bit data, so that it is not partitioned at all
+    if axis is None and isinstance(raw, np.ndarray) and raw.dtype in (np.uint8, np.uint16):
+        v_lower, v_upper = _percentile_from_histogram(raw, [lower, upper])
+    else:
+        v_lower, v_upper = np.percentile(raw, [lower, upper], axis=axis, keepdims=True)
+    if isinstance(raw, np.ndarray):
+        return _normalize_fused(raw, v_lower, v_upper - v_lower, eps)
+    return normalize(raw, v_lower, v_upper - v_lower, eps=eps)
 
 
 # TODO
@@ -90,6 +297,30 @@ def normalize_percentile(raw, lower=1.0, upper=99.0, axis=None, eps=1e-7):
 #
 
 
+def _get_rng():
+    # the noise augmentations for numpy data draw from a numpy generator, which can sample float32 directly.
+    # the generator is seeded from the global numpy random state for each call (which costs a single draw),
+    # so that np.random.seed (and the seeding of the data loader workers) determines the noise.
+    # torch tensors are sampled with the torch random generator on their device instead
+    return np.random.default_rng(np.random.randint(np.iinfo("int64").max, dtype="int64"))
+
+
+def _noise_dtype(img):
+    if torch.is_tensor(img):
+        return img.dtype if img.is_floating_point() else torch.float32
+    return img.dtype if img.dtype in (np.float32, np.float64) else np.dtype("float32")
+
+
+def _clip_inplace(img, clip_kwargs):
+    # clip the (freshly allocated) augmentation result in-place instead of allocating another array
+    a_min, a_max = clip_kwargs.get("a_min"), clip_kwargs.get("a_max")
+    if a_min is None and a_max is None:
+        return img
+    if torch.is_tensor(img):
+        return img.clamp_(a_min, a_max)
+    return np.clip(img, a_min, a_max, out=img)
+
+
 class RandomGamma:
     """
     Adjust contrast by non-liner transformation raising image value to power gamma.
@@ -109,9 +340,15 @@ class RandomGamma:
             raise ValueError(f"Gamma must be non-negative. Got {gamma}")
         if self.gain < 0.0:
             raise ValueError(f"Gain must be non-negative. Got {self.gain}")
-        result = self.gain * (img**gamma)
+        # apply the gain and clip in-place, so that only the array for the result is allocated
+        if _use_numexpr(img, transcendental=True):
+            result = _evaluate("gain * img ** gamma", img, gain=self.gain, gamma=gamma)
+        else:
+            result = torch.pow(img, gamma) if torch.is_tensor(img) else np.power(img, gamma)
+            if self.gain != 1.0:
+                result *= self.gain
         if self.clip_kwargs:
-            return np.clip(result, **self.clip_kwargs)
+            _clip_inplace(result, self.clip_kwargs)
         return result
 
 
@@ -129,9 +366,9 @@ class RandomBrightness:
             shift = np.random.uniform(self.alpha[0], self.alpha[1])
         else:
             shift = alpha
-        result = img + shift
+        result = _evaluate("img + shift", img, shift=shift) if _use_numexpr(img) else img + shift
         if self.clip_kwargs:
-            return np.clip(result, **self.clip_kwargs)
+            _clip_inplace(result, self.clip_kwargs)
         return result
 
 
@@ -148,11 +385,17 @@ class RandomContrast:
     def __call__(self, img, alpha=None):
         if alpha is None:
             alpha = np.random.uniform(self.alpha[0], self.alpha[1])
-        # mean = torch.mean(img)
-        mean = np.mean(img)
-        result = mean + alpha * (img - mean)
+        # img.mean works for numpy arrays and torch tensors
+        mean = img.mean()
+        # compute mean + alpha * (img - mean) with a single allocation
+        if _use_numexpr(img):
+            result = _evaluate("mean + alpha * (img - mean)", img, mean=mean, alpha=alpha)
+        else:
+            result = img - mean
+            result *= alpha
+            result += mean
         if self.clip_kwargs:
-            return np.clip(result, **self.clip_kwargs)
+            _clip_inplace(result, self.clip_kwargs)
         return result
 
 
@@ -170,10 +413,16 @@ class AdditiveGaussianNoise:
             std = np.random.uniform(self.alpha[0], self.alpha[1])
         else:
             std = alpha
-        gaussian_noise = np.random.normal(0, std, size=img.shape)
+        # sample the noise and add the image to it in-place, to avoid allocating temporary arrays
+        if torch.is_tensor(img):
+            noisy = torch.randn(img.shape, dtype=_noise_dtype(img), device=img.device).mul_(std).add_(img)
+        else:
+            noisy = _get_rng().standard_normal(img.shape, dtype=_noise_dtype(img))
+            noisy *= std
+            noisy += img
         if self.clip_kwargs:
-            return np.clip(img + gaussian_noise, dtype=img.dtype, **self.clip_kwargs)
-        return img + gaussian_noise
+            _clip_inplace(noisy, self.clip_kwargs)
+        return noisy
 
 
 class AdditivePoissonNoise:
@@ -189,10 +438,16 @@ class AdditivePoissonNoise:
 
     def __call__(self, img):
         lam = np.random.uniform(self.lam[0], self.lam[1])
-        poisson_noise = np.random.poisson(lam, size=img.shape) / lam
+        if torch.is_tensor(img):
+            rate = torch.full(img.shape, lam, dtype=_noise_dtype(img), device=img.device)
+            noisy = torch.poisson(rate).div_(lam).add_(img)
+        else:
+            noisy = np.empty(img.shape, dtype=_noise_dtype(img))
+            np.divide(_get_rng().poisson(lam, size=img.shape), lam, out=noisy)
+            noisy += img
         if self.clip_kwargs:
-            return np.clip(img + poisson_noise, 0, 1)
-        return img + poisson_noise
+            _clip_inplace(noisy, self.clip_kwargs)
+        return noisy
 
 
 class PoissonNoise:
@@ -208,33 +463,99 @@ class PoissonNoise:
         multiplier = np.random.uniform(self.multiplier[0], self.multiplier[1])
         # offset = img.min()
         # poisson_noise = np.random.poisson((img - offset) * multiplier)
-        poisson_noise = np.random.poisson(img / multiplier)
-        if isinstance(img, torch.Tensor):
-            poisson_noise = torch.Tensor(poisson_noise)
         # poisson_noise = poisson_noise / multiplier + offset
-        poisson_noise = poisson_noise * multiplier
+        if torch.is_tensor(img):
+            # sample on the tensor directly, instead of round-tripping through numpy
+            poisson_noise = torch.poisson(img / multiplier).mul_(multiplier)
+        else:
+            # compute the rate in the noise dtype, so that integer data is not promoted to float64.
+            # the generator samples int64, write the rescaled result back into the float buffer of the rate
+            rate = np.divide(img, multiplier, dtype=_noise_dtype(img))
+            poisson_noise = np.multiply(_get_rng().poisson(rate), multiplier, out=rate)
         if self.clip_kwargs:
-            return np.clip(poisson_noise, **self.clip_kwargs)
+            _clip_inplace(poisson_noise, self.clip_kwargs)
         return poisson_noise
 
 
+# the sigmas are quantized (see GaussianBlur), so the number of kernels is bounded by the sampling ranges
+@lru_cache(maxsize=None)
+def _gaussian_kernel1d(kernel_size, sigma):
+    # same kernel as in torchvision.transforms.GaussianBlur
+    half_size = (kernel_size - 1) * 0.5
+    x = torch.linspace(-half_size, half_size, steps=kernel_size, dtype=torch.float64)
+    pdf = torch.exp(-0.5 * (x / sigma).pow(2))
+    return pdf / pdf.sum()
+
+
+# the gaussian is separable, so we blur with the 1d kernel along both image axes, which needs
+# 2 * kernel_size instead of kernel_size ** 2 operations per pixel. like torchvision, we blur the last
+# two axes and use reflect padding (which corresponds to the 'mirror' mode in scipy)
+def _gaussian_blur_torch(img, kernel):
+    dtype = img.dtype if img.is_floating_point() else torch.float32
+    kernel = kernel.to(dtype=dtype, device=img.device)
+    size, pad = kernel.numel(), kernel.numel() // 2
+    blurred = F.pad(img.to(dtype).reshape((-1, 1) + img.shape[-2:]), (pad, pad, pad, pad), mode="reflect")
+    blurred = F.conv2d(blurred, kernel.view(1, 1, size, 1))
+    blurred = F.conv2d(blurred, kernel.view(1, 1, 1, size)).reshape(img.shape)
+    if not img.is_floating_point():
+        blurred = blurred.round_().to(img.dtype)
+    return blurred
+
+
+def _gaussian_blur_numpy(img, kernel):
+    kernel = kernel.numpy()
+    dtype = img.dtype if img.dtype in (np.float32, np.float64) else np.dtype("float32")
+    blurred = correlate1d(img, kernel, axis=-2, mode="mirror", output=dtype)
+    return correlate1d(blurred, kernel, axis=-1, mode="mirror", output=blurred)
+
+
 class GaussianBlur:
     """
     Blur the image.
     """
 
-    def __init__(self, kernel_size=(2, 12), sigma=(0, 2.5)):
+    def __init__(self, kernel_size=(2, 12), sigma=(0, 2.5), n_kernels=None):
         self.kernel_size = kernel_size
         self.sigma = sigma
+        # optionally sample a fixed table of kernels up-front, so that a call only needs to draw an index
+        self.kernels = None if n_kernels is None else [self._sample_kernel() for _ in range(n_kernels)]
 
-    def __call__(self, img):
+    def _sample_kernel(self):
         # sample kernel_size and make sure it is odd
         kernel_size = (
             2 * (np.random.randint(self.kernel_size[0], self.kernel_size[1]) // 2) + 1
         )
         # switch boundaries to make sure 0 is excluded from sampling
         sigma = np.random.uniform(self.sigma[1], self.sigma[0])
-        return transforms.GaussianBlur(kernel_size, sigma=sigma)(img)
+        # quantize sigma to steps of 0.05, so that the kernels can be cached
+        return _gaussian_kernel1d(kernel_size, max(round(sigma * 20) / 20, 0.05))
+
+    def __call__(self, img):
+        if self.kernels is None:
+            kernel = self._sample_kernel()
+        else:
+            kernel = self.kernels[np.random.randint(len(self.kernels))]
+        if torch.is_tensor(img):
+            return _gaussian_blur_torch(img, kernel)
+        return _gaussian_blur_numpy(img, kernel)
+
+
+class FastRandomApply:
+    """
+    Apply a transformation with probability p.
+
+    Lightweight alternative to torchvision.transforms.RandomApply, which is a torch.nn.Module
+    and samples from torch for each call.
+    """
+
+    def __init__(self, transform, p=0.5):
+        self.transform = transform
+        self.p = p
+
+    def __call__(self, img):
+        if np.random.random() < self.p:
+            return self.transform(img)
+        return img
 
 
 #
@@ -272,13 +593,13 @@ def get_default_mean_teacher_augmentations(p=0.3):
     aug1 = transforms.Compose(
         [
             normalize,
-            transforms.RandomApply([GaussianBlur()], p=p),
-            transforms.RandomApply([PoissonNoise()], p=p / 2),
-            transforms.RandomApply([AdditiveGaussianNoise()], p=p / 2),
+            FastRandomApply(GaussianBlur(), p=p),
+            FastRandomApply(PoissonNoise(), p=p / 2),
+            FastRandomApply(AdditiveGaussianNoise(), p=p / 2),
         ]
     )
-    aug2 = transforms.RandomApply(
-        [RandomContrast(clip_kwargs={"a_min": 0, "a_max": 1})], p=p
+    aug2 = FastRandomApply(
+        RandomContrast(clip_kwargs={"a_min": 0, "a_max": 1}), p=p
     )
     return get_raw_transform(normalizer=norm, augmentation1=aug1, augmentation2=aug2)
 
@@ -288,29 +609,34 @@ def apply_augmentations_test(raw, p=0.3):
     aug = transforms.Compose(
         [
             normalize,
-            transforms.RandomApply([RandomGamma(gamma=(3, 4))], p=p),
+            FastRandomApply(RandomGamma(gamma=(3, 4)), p=p),
         ]
     )
     aug_raw = aug(tensors_raw)
     return aug_raw
 
 
+RAW_AUGMENTATIONS = {
+    "GaussianBlur": GaussianBlur,
+    "RandomContrast": RandomContrast,
+    "AdditiveGaussianNoise": AdditiveGaussianNoise,
+    "AdditivePoissonNoise": AdditivePoissonNoise,
+    "PoissonNoise": PoissonNoise,
+    "RandomGamma": RandomGamma,
+    "RandomBrightness": RandomBrightness,
+}
+
+
 def get_raw_augmentations(transform_inputs):
-    transform_available = {
-        "GaussianBlur": GaussianBlur,
-        "RandomContrast": RandomContrast,
-        "AdditiveGaussianNoise": AdditiveGaussianNoise,
-        "AdditivePoissonNoise": AdditivePoissonNoise,
-        "PoissonNoise": PoissonNoise,
-        "RandomGamma": RandomGamma,
-        "RandomBrightness": RandomBrightness,
-    }
     group_of_transforms = [normalize]
     for t, p, param in transform_inputs:
-        assert t in transform_available.keys(), f"{t} not available"
-        group_of_transforms.append(
-            transforms.RandomApply([transform_available[t](**param)], p=p["p"])
-        )
+        assert t in RAW_AUGMENTATIONS, f"{t} not available"
+        p = p["p"]
+        # skip augmentations that are never applied and don't sample for the ones that are always applied
+        if p <= 0:
+            continue
+        transform = RAW_AUGMENTATIONS[t](**param)
+        group_of_transforms.append(transform if p >= 1 else FastRandomApply(transform, p=p))
 
     # compose aug using transforms.Compose from list of strings inputed as raw_tranforms
     aug = transforms.Compose(group_of_transforms)
@@ -318,17 +644,6 @@ def get_raw_augmentations(transform_inputs):
 
 
 def get_single_TTA_raw_augmentations(transform_input):
-    transform_available = {
-        "GaussianBlur": GaussianBlur,
-        "RandomContrast": RandomContrast,
-        "AdditiveGaussianNoise": AdditiveGaussianNoise,
-        "AdditivePoissonNoise": AdditivePoissonNoise,
-        "PoissonNoise": PoissonNoise,
-        "RandomGamma": RandomGamma,
-        "RandomBrightness": RandomBrightness,
-    }
-    assert (
-        transform_input[0] in transform_available.keys()
-    ), f"{transform_input[0]} not available"
-    transform = transform_available[transform_input[0]](**transform_input[1])
+    assert transform_input[0] in RAW_AUGMENTATIONS, f"{transform_input[0]} not available"
+    transform = RAW_AUGMENTATIONS[transform_input[0]](**transform_input[1])
     return transform